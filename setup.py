@@ -0,0 +1,12 @@
+import os
+
+from setuptools import setup
+
+ext_modules = []
+# Compiling the analyzer needs mypy and a C toolchain, so only do it on request (e.g. in CI wheel builds)
+if os.environ.get('SCRIPT_DEPS_USE_MYPYC') == '1':
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(['src/script_deps/analyzer.py'])
+
+setup(ext_modules=ext_modules)
@@ -0,0 +1,100 @@
+import ast
+import os
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+_IMPORT_T = ast.Import
+_FROM_T = ast.ImportFrom
+# Statements whose nested blocks may hold import statements, keyed by exact node type
+BLOCK_FIELDS: Dict[type, Tuple[str, ...]] = {
+    ast.If: ('body', 'orelse'),
+    ast.For: ('body', 'orelse'),
+    ast.AsyncFor: ('body', 'orelse'),
+    ast.While: ('body', 'orelse'),
+    ast.Match: ('cases',),
+    ast.match_case: ('body',),
+    ast.Try: ('body', 'handlers', 'orelse', 'finalbody'),
+    ast.TryStar: ('body', 'handlers', 'orelse', 'finalbody'),
+    ast.ExceptHandler: ('body',),
+    ast.With: ('body',),
+    ast.AsyncWith: ('body',),
+    ast.FunctionDef: ('body',),
+    ast.AsyncFunctionDef: ('body',),
+    ast.ClassDef: ('body',),
+}
+
+
+def parse_imports(source: bytes) -> Set[str]:
+    """Parse Python source and return the dotted module names it imports."""
+    imports: Set[str] = set()
+    # Every import statement contains the keyword, so skip parsing sources without it
+    if b'import' not in source:
+        return imports
+
+    tree = ast.parse(source)
+    # Only statement blocks can hold imports, so skip expressions entirely
+    stack: List[ast.AST] = list(tree.body)
+    while stack:
+        node = stack.pop()
+        if type(node) is _IMPORT_T:
+            for name in node.names:
+                imports.add(name.name)
+        elif type(node) is _FROM_T:
+            if node.module:
+                imports.add(node.module)
+        else:
+            for field in BLOCK_FIELDS.get(type(node), ()):
+                stack.extend(getattr(node, field))
+    return imports
+
+
+def analyze_file(file_path: str) -> Optional[Dict[str, Any]]:
+    """Build an import cache entry for a source file, or None if it cannot be parsed."""
+    try:
+        stat = os.stat(file_path)
+        with open(file_path, 'rb') as f:
+            imports = parse_imports(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return None
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'imports': sorted(imports)}
+
+
+def is_project_path(path_str: str, root_prefix: str, gateway_str: str, excluded_dirs: FrozenSet[str]) -> bool:
+    """Check if a path is under the root prefix, is not the gateway and has no excluded directory."""
+    if path_str == gateway_str or not path_str.startswith(root_prefix):
+        return False
+    rel_dirs = path_str[len(root_prefix):].split(os.sep)[:-1]
+    return excluded_dirs.isdisjoint(rel_dirs)
+
+
+def is_under_any(module_path: Path, prefixes: Tuple[Path, ...]) -> bool:
+    """Check if a path equals or lies under any of the given prefixes."""
+    parents = module_path.parents
+    for prefix in prefixes:
+        if prefix == module_path or prefix in parents:
+            return True
+    return False
+
+
+def walk_import_graph(start: Path, imports_of: Callable[[Path], Set[str]],
+                      resolve: Callable[[str], Optional[Path]]) -> Iterator[Path]:
+    """Yield project files reachable from start through imports, breadth-first.
+
+    resolve maps an import name to a project path, or None for anything outside the project.
+    """
+    queue = deque([start])
+    seen = {start}
+    while queue:
+        current_path = queue.popleft()
+        for import_name in imports_of(current_path):
+            module_path = resolve(import_name)
+            if module_path is None or module_path in seen:
+                continue
+            seen.add(module_path)
+            # Namespace packages resolve to a directory with no source of their own
+            if not module_path.is_file():
+                continue
+            yield module_path
+            if module_path.suffix == '.py':
+                queue.append(module_path)
@@ -1,174 +1,437 @@
-import ast
 import argparse
-import importlib
+import functools
+import importlib.abc
+import importlib.metadata
+import importlib.util
+import json
 import os
+import site
 import sys
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from types import ModuleType
-from typing import Set, List
+from typing import Set, List, Optional, Dict, Iterator, Callable, Mapping
 import pytest
-import pkg_resources
+
+if not __package__:
+    # Running this file directly as a script: make the script_deps package importable
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from script_deps.analyzer import analyze_file, is_project_path, is_under_any, parse_imports, walk_import_graph
+
+IMPORT_CACHE_FILENAME = '.script_deps_cache.json'
+# Bump whenever parse_imports changes what it reports, so stale import sets are dropped
+IMPORT_CACHE_VERSION = 1
+# Directories pruned from the project walk; only user excludes and real venvs also reject collected modules
+EXCLUDED_DIRS = frozenset({'venv', '.venv', 'env', 'site-packages', '.tox', 'node_modules', '__pycache__', '.git'})
+# Projects with more source files than this are parsed up front in worker processes
+PARALLEL_ANALYSIS_THRESHOLD = 500
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_path(path: str) -> Path:
+    """Resolve a module file path, memoized per raw path string."""
+    # Always resolve: sys.path entries may go through symlinks while root_path is a realpath
+    return Path(path).resolve()
+
+
+@functools.lru_cache(maxsize=None)
+def locate_module(module_name: str) -> Optional[Path]:
+    """Find the file path for a given module name without importing it."""
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except (ImportError, ValueError):
+        # Broken packages can raise while their parents are being resolved
+        return None
+    if spec is None:
+        return None
+    if spec.origin and spec.has_location:
+        return resolve_path(spec.origin)
+    # Namespace packages have no origin file, only their package directories
+    if spec.submodule_search_locations:
+        return resolve_path(next(iter(spec.submodule_search_locations)))
+    # Built-in and frozen modules have no file on disk
+    return None
+
+
+class ImportRecorder(importlib.abc.MetaPathFinder):
+    """Meta path finder that records module files accepted by a filter as they are imported."""
+
+    def __init__(self, accept: Callable[[Path], bool]):
+        self.accept = accept
+        self.module_paths: Set[Path] = set()
+
+    def find_spec(self, fullname, path, target=None):
+        """Delegate to the finders after this one and record the resolved module file."""
+        # Finders ahead of this one have already declined the import
+        for finder in sys.meta_path[sys.meta_path.index(self) + 1:]:
+            if not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        if spec.origin and spec.has_location:
+            module_path = resolve_path(spec.origin)
+            if self.accept(module_path):
+                self.module_paths.add(module_path)
+        return spec
 
 
 class DependencyCollector:
-    def __init__(self, gateway_path: str, root_path: str, output_path: str = None):
+    def __init__(self, gateway_path: str, root_path: str, output_path: str = None, exclude_dirs: List[str] = None,
+                 verbose: bool = False):
         self.gateway_path = Path(gateway_path).resolve()
         self.root_path = Path(root_path).resolve()
-        self.output_path = Path(output_path) if output_path else self.gateway_path.parent
+        self.output_path = Path(output_path).resolve() if output_path else self.gateway_path.parent
+        self._gateway_str = str(self.gateway_path)
+        self._root_prefix = os.path.join(str(self.root_path), '')
+        self.excluded_dirs = frozenset(exclude_dirs or ())
+        self.walk_excluded_dirs = EXCLUDED_DIRS | self.excluded_dirs
+        self.verbose = verbose
+        self._messages: List[str] = []
         self.collected_modules: Set[str] = set()
         self.collected_files: Set[Path] = set()
         self.third_party_packages: Set[str] = set()
         self.config_extensions = {'.txt', '.yaml', '.yml', '.json'}  # Add more if needed
+        self._config_suffixes = tuple(sorted(self.config_extensions))
+        # Keep the cache with the project, never inside the deployable bundle
+        self.import_cache_path = self.root_path / IMPORT_CACHE_FILENAME
+        self.import_cache: Dict[str, dict] = self.load_import_cache()
+        venv_prefixes = {Path(prefix).resolve() for prefix in (*site.getsitepackages(), site.getusersitepackages())}
+        # A system interpreter's prefix also holds the stdlib and often projects (/usr/src/app)
+        if sys.prefix != sys.base_prefix:
+            venv_prefixes.update(Path(prefix).resolve() for prefix in (sys.prefix, sys.exec_prefix))
+        # A prefix containing the project would mark every project module as third-party
+        self._venv_prefixes = tuple(
+            prefix for prefix in venv_prefixes
+            if prefix != self.root_path and prefix not in self.root_path.parents
+        )
+        self._venv_modules: Dict[Path, bool] = {}
+        self._venv_dirs: Dict[str, bool] = {}
+        self._distributions_by_module: Optional[Mapping[str, List[str]]] = None
+        self._package_names: Dict[str, Optional[str]] = {}
+        self._distribution_files: Dict[str, Dict[Path, str]] = {}
+        self._scanned_dirs: Set[str] = set()
+        self._source_files: Optional[List[str]] = None
+        self._config_files: Dict[str, List[str]] = {}
 
         # Add gateway script to collected files
         self.collected_files.add(self.gateway_path)
 
+    def log(self, message: str):
+        """Buffer a per-file message, shown only in verbose mode."""
+        if self.verbose:
+            self._messages.append(message)
+
+    def flush_log(self):
+        """Write buffered messages to stdout in a single call."""
+        if self._messages:
+            sys.stdout.write("\n".join(self._messages) + "\n")
+            self._messages.clear()
+
     def is_venv_module(self, module_path: Path) -> bool:
         """Check if module is from virtual environment."""
-        return 'venv' in str(module_path).lower() or 'site-packages' in str(module_path)
-
-    def get_package_name(self, module_path: Path) -> str:
-        """Get the package name from a module path."""
-        try:
-            dist = pkg_resources.working_set.find(
-                pkg_resources.Requirement.parse(module_path.parts[-2])
-            )
-            return f"{dist.key}=={dist.version}" if dist else None
-        except:
-            return None
+        is_venv = self._venv_modules.get(module_path)
+        if is_venv is None:
+            is_venv = is_under_any(module_path, self._venv_prefixes)
+            self._venv_modules[module_path] = is_venv
+        return is_venv
+
+    def get_package_name(self, module_name: str) -> Optional[str]:
+        """Get the pinned distribution that provides a module, given its dotted import name."""
+        if module_name in self._package_names:
+            return self._package_names[module_name]
+        if self._distributions_by_module is None:
+            # Map every installed top-level module to its distributions in a single pass
+            self._distributions_by_module = importlib.metadata.packages_distributions()
+
+        top_level = module_name.split('.')[0]
+        dist_names = self._distributions_by_module.get(top_level, [])
+        dist_name = None
+        if len(dist_names) == 1:
+            dist_name = dist_names[0]
+        elif len(dist_names) > 1:
+            # Namespace packages such as google are shared, so find the distribution owning the module file.
+            # Candidates are derived from the namespace directory rather than imported, falling back to
+            # parent packages when the dotted name ends in a non-module.
+            namespace_dir = locate_module(top_level)
+            owners = self.get_distribution_files(top_level, dist_names)
+            parts = module_name.split('.')[1:]
+            while namespace_dir and parts and dist_name is None:
+                for candidate in (namespace_dir.joinpath(*parts, '__init__.py'),
+                                  namespace_dir.joinpath(*parts[:-1], f'{parts[-1]}.py')):
+                    dist_name = owners.get(candidate)
+                    if dist_name:
+                        break
+                parts.pop()
+
+        package_name = None
+        if dist_name:
+            try:
+                package_name = f"{dist_name.lower()}=={importlib.metadata.version(dist_name)}"
+            except importlib.metadata.PackageNotFoundError:
+                pass
+        self._package_names[module_name] = package_name
+        return package_name
+
+    def get_distribution_files(self, top_level: str, dist_names: List[str]) -> Dict[Path, str]:
+        """Map the installed files of the distributions sharing a top-level module to their owner."""
+        owners = self._distribution_files.get(top_level)
+        if owners is None:
+            owners = {}
+            for dist_name in dist_names:
+                try:
+                    dist = importlib.metadata.distribution(dist_name)
+                except importlib.metadata.PackageNotFoundError:
+                    continue
+                # Resolve the install location once and join the relative record paths onto it
+                base_dir = resolve_path(str(dist.locate_file('')))
+                for dist_file in dist.files or ():
+                    if dist_file.parts and dist_file.parts[0] == top_level:
+                        owners[base_dir.joinpath(*dist_file.parts)] = dist_name
+            self._distribution_files[top_level] = owners
+        return owners
 
     def find_module_path(self, module_name: str) -> Path:
-        """Find the file path for a given module name."""
-        try:
-            module = importlib.import_module(module_name)
-            if hasattr(module, '__file__') and module.__file__:
-                module_path = Path(module.__file__).resolve()
-                if self.is_venv_module(module_path):
-                    package_name = self.get_package_name(module_path)
-                    if package_name:
-                        self.third_party_packages.add(package_name)
-                return module_path
-        except ImportError:
-            return None
+        """Find the file path of the top-level package for a dotted module name."""
+        module_path = locate_module(module_name.split('.')[0])
+        if module_path and self.is_venv_module(module_path):
+            package_name = self.get_package_name(module_name)
+            if package_name:
+                self.third_party_packages.add(package_name)
+        return module_path
 
     def create_requirements_txt(self):
         """Create requirements.txt file with third-party dependencies."""
         if self.third_party_packages:
             requirements_path = self.output_path / 'requirements.txt'
-            with open(requirements_path, 'w') as f:
-                for package in sorted(self.third_party_packages):
-                    f.write(f"{package}\n")
+            requirements_path.write_text("\n".join(sorted(self.third_party_packages)) + "\n")
             print(f"\nCreated requirements.txt with {len(self.third_party_packages)} packages")
 
-    def copy_dependencies(self):
+    def copy_dependencies(self, preserve_metadata: bool = False):
         """Copy collected dependencies to output directory."""
+        # Copying stat metadata costs extra syscalls per file, so only do it on request
+        copy_file = shutil.copy2 if preserve_metadata else shutil.copyfile
         copied_count = 0
         config_count = 0
-        for file_path in self.collected_files:
-            if self.is_project_module(file_path) and not self.is_venv_module(file_path):
-                # Calculate relative path from root
-                try:
-                    rel_path = file_path.relative_to(self.root_path)
-                    target_path = self.output_path / rel_path
-
-                    # Create directory structure
-                    target_path.parent.mkdir(parents=True, exist_ok=True)
-
-                    # Copy file
-                    shutil.copy2(file_path, target_path)
-
-                    # Count files by type
-                    if file_path.suffix.lower() in self.config_extensions:
-                        config_count += 1
-                    else:
-                        copied_count += 1
-
-                    print(f"Copied: {rel_path}")
-                except ValueError:
-                    continue
-
+        # Filter once up front, so every remaining file is known to be under root_path
+        packaged_files = [
+            file_path for file_path in self.collected_files
+            if self.is_project_module(file_path) and not self.is_venv_module(file_path)
+        ]
+        for file_path in packaged_files:
+            rel_path = file_path.relative_to(self.root_path)
+            target_path = self.output_path / rel_path
+
+            # Create directory structure
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Copy file
+            copy_file(file_path, target_path)
+
+            # Count files by type
+            if file_path.name.lower().endswith(self._config_suffixes):
+                config_count += 1
+            else:
+                copied_count += 1
+
+            self.log(f"Copied: {rel_path}")
+
+        self.flush_log()
         print(f"\nCopied {copied_count} project files and {config_count} configuration files")
         self.create_requirements_txt()
 
+    def load_import_cache(self) -> Dict[str, dict]:
+        """Load cached import analysis results from a previous run."""
+        try:
+            with open(self.import_cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != IMPORT_CACHE_VERSION:
+            return {}
+        files = cache.get('files')
+        if not isinstance(files, dict):
+            return {}
+        # Drop malformed entries rather than failing on them later
+        return {
+            file_path: entry for file_path, entry in files.items()
+            if isinstance(entry, dict) and isinstance(entry.get('mtime_ns'), int)
+            and isinstance(entry.get('size'), int) and isinstance(entry.get('imports'), list)
+        }
+
+    def save_import_cache(self):
+        """Persist import analysis results for the next run."""
+        try:
+            with open(self.import_cache_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': IMPORT_CACHE_VERSION, 'files': self.import_cache}, f)
+        except OSError:
+            # The cache only speeds up later runs, so a read-only project is not an error
+            pass
+
+    def is_cache_fresh(self, file_path: str, stat: os.stat_result) -> bool:
+        """Check if the cached imports of a file match its current stat."""
+        entry = self.import_cache.get(file_path)
+        return bool(entry) and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
     def analyze_imports(self, file_path: Path) -> Set[str]:
         """Analyze Python file for import statements using AST."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            tree = ast.parse(f.read())
-
-        imports = set()
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Import):
-                for name in node.names:
-                    imports.add(name.name.split('.')[0])
-            elif isinstance(node, ast.ImportFrom):
-                if node.module:
-                    imports.add(node.module.split('.')[0])
+        cache_key = str(file_path)
+        stat = file_path.stat()
+        if self.is_cache_fresh(cache_key, stat):
+            return set(self.import_cache[cache_key]['imports'])
+
+        with open(file_path, 'rb') as f:
+            imports = parse_imports(f.read())
+
+        self.import_cache[cache_key] = {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'imports': sorted(imports),
+        }
         return imports
 
-    def is_project_module(self, module_path: Path) -> bool:
-        """Check if module path is under the project root path."""
-        if module_path == self.gateway_path:
-            return False
-        try:
-            module_path.relative_to(self.root_path)
-            return True
-        except ValueError:
-            return False
+    def index_project(self):
+        """Walk the project root once, indexing its source and configuration files."""
+        if self._source_files is not None:
+            return
 
-    def collect_runtime_dependencies(self, tests_path: str):
-        """Collect runtime dependencies by running tests."""
-        original_modules = set(sys.modules.keys())
+        self._source_files = []
+        for dir_path, dir_names, file_names in os.walk(self.root_path):
+            dir_names[:] = [name for name in dir_names if name not in self.walk_excluded_dirs]
+            config_files = []
+            for file_name in file_names:
+                if file_name.endswith('.py'):
+                    self._source_files.append(os.path.join(dir_path, file_name))
+                elif file_name.lower().endswith(self._config_suffixes):
+                    config_files.append(os.path.join(dir_path, file_name))
+            if config_files:
+                self._config_files[dir_path] = config_files
+
+    def prefetch_imports(self):
+        """Parse project sources in worker processes when the project is large."""
+        self.index_project()
+        source_files = self._source_files
+        if len(source_files) <= PARALLEL_ANALYSIS_THRESHOLD:
+            return
 
+        stale_files = []
+        for file_path in source_files:
+            try:
+                if not self.is_cache_fresh(file_path, os.stat(file_path)):
+                    stale_files.append(file_path)
+            except OSError:
+                continue
+        if not stale_files:
+            return
+
+        workers = os.cpu_count() or 1
+        if workers == 1:
+            # A single worker process only adds startup and pickling overhead
+            self.store_import_entries(stale_files, map(analyze_file, stale_files))
+            return
+
+        chunksize = max(1, len(stale_files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            self.store_import_entries(stale_files, executor.map(analyze_file, stale_files, chunksize=chunksize))
+
+    def store_import_entries(self, file_paths: List[str], entries: Iterator[Optional[dict]]):
+        """Add analyzed files to the import cache."""
+        # Unparseable files stay uncached and only fail if the static walk reaches them
+        for file_path, entry in zip(file_paths, entries):
+            if entry:
+                self.import_cache[file_path] = entry
+
+    def is_project_module(self, module_path: Path) -> bool:
+        """Check if module path is under the project root path and outside excluded directories."""
+        path_str = str(module_path)
+        return (is_project_path(path_str, self._root_prefix, self._gateway_str, self.excluded_dirs)
+                and not self.is_in_project_venv(path_str))
+
+    def is_in_project_venv(self, path_str: str) -> bool:
+        """Check if a path under the project root lies inside a virtual environment directory."""
+        dir_str = str(self.root_path)
+        for part in path_str[len(self._root_prefix):].split(os.sep)[:-1]:
+            dir_str = os.path.join(dir_str, part)
+            is_venv = self._venv_dirs.get(dir_str)
+            if is_venv is None:
+                # Recognize venvs by their marker file rather than by directory name, so a package named env is kept
+                is_venv = os.path.isfile(os.path.join(dir_str, 'pyvenv.cfg'))
+                self._venv_dirs[dir_str] = is_venv
+            if is_venv:
+                return True
+        return False
+
+    def resolve_project_module(self, import_name: str) -> Optional[Path]:
+        """Find the file path for an import name if it belongs to the project."""
+        module_path = self.find_module_path(import_name)
+        if module_path and self.is_project_module(module_path):
+            return module_path
+        return None
+
+    def collect_runtime_dependencies(self, tests_path: str, collect_only: bool = False):
+        """Collect runtime dependencies by running tests, or only collecting them."""
         # Add tests directory to Python path
         sys.path.insert(0, str(Path(tests_path).parent))
 
-        # Run pytest with capture=no to show test output
-        pytest.main([tests_path, '-v'])
-
-        # Get new modules loaded during test execution
-        new_modules = set(sys.modules.keys()) - original_modules
+        # Record project modules as they are imported instead of diffing sys.modules afterwards
+        recorder = ImportRecorder(self.is_project_module)
+        sys.meta_path.insert(0, recorder)
+        try:
+            if collect_only:
+                # Importing the test modules is enough to load their dependencies
+                pytest.main([tests_path, '--collect-only', '-q', '--no-header', '-p', 'no:cacheprovider'])
+            else:
+                pytest.main([tests_path, '-v'])
+        finally:
+            sys.meta_path.remove(recorder)
+
+        for module_path in recorder.module_paths:
+            self.collected_files.add(module_path)
+            self.collect_config_files(module_path)
+        self.flush_log()
+
+    def find_config_files(self, directory: Path) -> Iterator[Path]:
+        """Yield indexed configuration files under a directory not covered by an earlier scan."""
+        if any(str(scanned) in self._scanned_dirs for scanned in (directory, *directory.parents)):
+            return
+        self._scanned_dirs.add(str(directory))
 
-        for module_name in new_modules:
-            module = sys.modules.get(module_name)
-            if module and hasattr(module, '__file__') and module.__file__:
-                module_path = Path(module.__file__).resolve()
-                if self.is_project_module(module_path):
-                    self.collected_files.add(module_path)
-                    # Add this line to collect config files from runtime dependencies
-                    self.collect_config_files(module_path)
+        self.index_project()
+        dir_str = str(directory)
+        dir_prefix = os.path.join(dir_str, '')
+        for dir_path, config_files in self._config_files.items():
+            if dir_path == dir_str or dir_path.startswith(dir_prefix):
+                for config_file in config_files:
+                    yield Path(config_file)
 
     def collect_config_files(self, module_path: Path):
         """Collect configuration files from the module's directory."""
         if not module_path.is_file():
             return
 
-        module_dir = module_path.parent
-        for file_path in module_dir.rglob('*'):
-            if file_path.suffix.lower() in self.config_extensions:
-                try:
-                    # Check if the config file is under root_path
-                    if self.is_project_module(file_path):
-                        self.collected_files.add(file_path)
-                        print(f"Found config file: {file_path.relative_to(self.root_path)}")
-                except ValueError:
-                    continue
+        for file_path in self.find_config_files(module_path.parent):
+            # Check if the config file is under root_path
+            if (file_path != self.import_cache_path and file_path not in self.collected_files
+                    and self.is_project_module(file_path)):
+                self.collected_files.add(file_path)
+                self.log(f"Found config file: {file_path.relative_to(self.root_path)}")
 
     def collect_static_dependencies(self, file_path: Path):
-        """Recursively collect static dependencies from import statements."""
-        imports = self.analyze_imports(file_path)
+        """Collect static dependencies from import statements, breadth-first."""
+        self.prefetch_imports()
 
-        # Collect config files from the current module's directory
+        # Collect config files from the entry module's directory
         self.collect_config_files(file_path)
-        for import_name in imports:
-            module_path = self.find_module_path(import_name)
-            if module_path and self.is_project_module(module_path):
-                if module_path not in self.collected_files:
-                    self.collected_files.add(module_path)
-                    # Collect config files from the imported module's directory
-                    self.collect_config_files(module_path)
-                    self.collect_static_dependencies(module_path)
-        print()
+        for module_path in walk_import_graph(file_path, self.analyze_imports, self.resolve_project_module):
+            self.collected_files.add(module_path)
+            # Collect config files from the imported module's directory
+            self.collect_config_files(module_path)
+        self.flush_log()
 
 
 def main():
@@ -177,13 +440,22 @@ def main():
     parser.add_argument('root_path', help='Root path of the project')
     parser.add_argument('--output-path', help='Output path for dependencies', default=None)
     parser.add_argument('--tests-path', help='Path to test files', required=True)
+    parser.add_argument('--exclude', action='append', default=[], metavar='DIR',
+                        help='Directory name to skip when walking the project (repeatable)')
+    parser.add_argument('--preserve-metadata', action='store_true',
+                        help='Preserve file permissions and timestamps when copying')
+    parser.add_argument('--verbose', action='store_true', help='List every collected and copied file')
+    parser.add_argument('--collect-only', action='store_true',
+                        help='Only collect tests instead of running them (misses imports made inside test bodies)')
 
     args = parser.parse_args()
 
     collector = DependencyCollector(
         args.gateway_path,
         args.root_path,
-        args.output_path
+        args.output_path,
+        args.exclude,
+        args.verbose
     )
 
     # Collect static dependencies
@@ -192,11 +464,12 @@ def main():
 
     # Collect runtime dependencies
     print("\nCollecting runtime dependencies...")
-    collector.collect_runtime_dependencies(args.tests_path)
+    collector.collect_runtime_dependencies(args.tests_path, args.collect_only)
 
     # Copy dependencies
     print("\nCopying dependencies...")
-    collector.copy_dependencies()
+    collector.copy_dependencies(args.preserve_metadata)
+    collector.save_import_cache()
 
 
 if __name__ == '__main__':
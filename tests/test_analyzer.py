@@ -0,0 +1,66 @@
+import os
+from pathlib import Path
+
+from script_deps.analyzer import is_project_path, parse_imports, walk_import_graph
+
+
+def test_parse_imports_collects_module_names():
+    source = b"import os.path\nimport json as j\nfrom pkg.sub import name\nfrom . import sibling\n"
+    assert parse_imports(source) == {'os.path', 'json', 'pkg.sub'}
+
+
+def test_parse_imports_descends_into_statement_blocks():
+    source = b"""
+if flag:
+    import a
+else:
+    import b
+try:
+    import c
+except ImportError:
+    import d
+for item in items:
+    import e
+while flag:
+    import f
+match value:
+    case 1:
+        import g
+class K:
+    def method(self):
+        with ctx:
+            import h
+"""
+    assert parse_imports(source) == set('abcdefgh')
+
+
+def test_parse_imports_skips_sources_without_imports():
+    assert parse_imports(b"this is not valid python (") == set()
+
+
+def test_is_project_path():
+    root_prefix = os.path.join(os.sep + 'app', '')
+    gateway = os.path.join(root_prefix, 'handler.py')
+    excluded = frozenset({'venv'})
+
+    assert is_project_path(os.path.join(root_prefix, 'pkg', 'mod.py'), root_prefix, gateway, excluded)
+    assert not is_project_path(gateway, root_prefix, gateway, excluded)
+    assert not is_project_path(os.path.join(os.sep + 'app-old', 'mod.py'), root_prefix, gateway, excluded)
+    assert not is_project_path(os.path.join(root_prefix, 'venv', 'lib', 'mod.py'), root_prefix, gateway, excluded)
+
+
+def test_walk_import_graph_visits_each_module_once(tmp_path: Path):
+    modules = {name: tmp_path / f'{name}.py' for name in ('gw', 'a', 'b', 'c')}
+    for module_path in modules.values():
+        module_path.touch()
+    graph = {'gw': {'a', 'b', 'os'}, 'a': {'c'}, 'b': {'c'}, 'c': {'a'}}
+    analyzed = []
+
+    def imports_of(module_path: Path):
+        analyzed.append(module_path.stem)
+        return graph[module_path.stem]
+
+    found = list(walk_import_graph(modules['gw'], imports_of, modules.get))
+
+    assert sorted(path.stem for path in found) == ['a', 'b', 'c']
+    assert sorted(analyzed) == ['a', 'b', 'c', 'gw']
@@ -0,0 +1,98 @@
+import site
+import sys
+from pathlib import Path
+
+import pytest
+
+from script_deps.main import DependencyCollector
+
+
+@pytest.fixture
+def project(tmp_path: Path) -> Path:
+    root = tmp_path / 'proj'
+    (root / 'pkg' / 'sub').mkdir(parents=True)
+    (root / 'gw.py').write_text('import pkg\n')
+    (root / 'pkg' / '__init__.py').write_text('')
+    (root / 'pkg' / 'settings.yaml').write_text('a: 1\n')
+    (root / 'pkg' / 'sub' / 'extra.json').write_text('{}\n')
+    return root
+
+
+def make_collector(root: Path, output_path: str = None) -> DependencyCollector:
+    return DependencyCollector(str(root / 'gw.py'), str(root), output_path)
+
+
+def test_is_venv_module_ignores_interpreter_prefix_containing_project(project: Path, monkeypatch):
+    site_packages = project.parent / 'site-packages'
+    monkeypatch.setattr(site, 'getsitepackages', lambda: [str(site_packages)])
+    monkeypatch.setattr(site, 'getusersitepackages', lambda: str(site_packages))
+
+    # System interpreter whose prefix holds both the stdlib and the project (/usr, /usr/src/app)
+    monkeypatch.setattr(sys, 'prefix', str(project.parent))
+    monkeypatch.setattr(sys, 'exec_prefix', str(project.parent))
+    monkeypatch.setattr(sys, 'base_prefix', str(project.parent))
+    collector = make_collector(project)
+    assert not collector.is_venv_module(project / 'pkg' / '__init__.py')
+    assert collector.is_venv_module(site_packages / 'yaml' / '__init__.py')
+
+    # The stdlib under a system interpreter's prefix is not third-party
+    interpreter_prefix = project.parent / 'usr'
+    monkeypatch.setattr(sys, 'prefix', str(interpreter_prefix))
+    monkeypatch.setattr(sys, 'exec_prefix', str(interpreter_prefix))
+    monkeypatch.setattr(sys, 'base_prefix', str(interpreter_prefix))
+    collector = make_collector(project)
+    assert not collector.is_venv_module(interpreter_prefix / 'lib' / 'json' / '__init__.py')
+
+    # A virtual environment that contains the project is not a third-party prefix either
+    monkeypatch.setattr(sys, 'base_prefix', str(project.parent.parent / 'base'))
+    collector = make_collector(project)
+    assert not collector.is_venv_module(project / 'pkg' / '__init__.py')
+
+
+def test_import_cache_is_never_collected_or_packaged(project: Path, monkeypatch):
+    monkeypatch.chdir(project.parent)
+    monkeypatch.syspath_prepend(str(project))
+
+    for _ in range(2):
+        collector = make_collector(project, output_path='proj/build')
+        collector.collect_static_dependencies(collector.gateway_path)
+        collector.copy_dependencies()
+        collector.save_import_cache()
+
+        assert collector.import_cache_path.is_file()
+        assert collector.import_cache_path not in collector.collected_files
+    assert not list((project / 'build').rglob('.script_deps_cache.json'))
+
+
+def write_distribution(site_dir: Path, name: str, files: list):
+    dist_info = site_dir / f'{name}-1.0.dist-info'
+    dist_info.mkdir(parents=True)
+    (dist_info / 'METADATA').write_text(f'Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n')
+    (dist_info / 'RECORD').write_text(''.join(f'{file},,\n' for file in files))
+    for file in files:
+        (site_dir / file).parent.mkdir(parents=True, exist_ok=True)
+        (site_dir / file).write_text('')
+
+
+def test_get_package_name_disambiguates_shared_namespace(project: Path, tmp_path: Path, monkeypatch):
+    site_dir = tmp_path / 'site'
+    write_distribution(site_dir, 'alpha', ['sdtestns/alpha/__init__.py'])
+    write_distribution(site_dir, 'beta', ['sdtestns/beta.py'])
+    write_distribution(site_dir, 'solo', ['sdtestsolo/__init__.py'])
+    monkeypatch.syspath_prepend(str(site_dir))
+
+    collector = make_collector(project)
+    assert collector.get_package_name('sdtestns.alpha.client') == 'alpha==1.0'
+    assert collector.get_package_name('sdtestns.beta') == 'beta==1.0'
+    assert collector.get_package_name('sdtestns') is None
+    assert collector.get_package_name('sdtestsolo.anything') == 'solo==1.0'
+
+
+def test_find_config_files_skips_scanned_subtrees(project: Path):
+    collector = make_collector(project)
+    pkg = project / 'pkg'
+
+    assert list(collector.find_config_files(pkg / 'sub')) == [pkg / 'sub' / 'extra.json']
+    assert sorted(collector.find_config_files(pkg)) == [pkg / 'settings.yaml', pkg / 'sub' / 'extra.json']
+    assert list(collector.find_config_files(pkg)) == []
+    assert list(collector.find_config_files(pkg / 'sub')) == []